@@ -0,0 +1,399 @@
+import os
+import sys
+import csv
+import json
+import zipfile
+import time
+import signal
+import socket
+import sqlite3
+import threading
+import traceback
+import multiprocessing
+from collections import Counter
+from multiprocessing.connection import wait
+
+def write_report(rows, report_path):
+    if not rows:
+        print("Nothing to report.")
+        return
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    if report_path.lower().endswith('.json'):
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=2)
+    else:
+        fieldnames = []
+        for row in rows:
+            for key in row:
+                if key not in fieldnames:
+                    fieldnames.append(key)
+        with open(report_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+    print(f"Report written to: {report_path}")
+
+JOURNAL_NAME = '.batch_journal.{stage}.jsonl'
+PROFILE_TIME_BUDGET = None
+PROFILE_INTERVAL = 0.01
+PROFILE_FOLDER_NAME = 'profiles'
+BATCH_WORKERS = 1
+BOOK_TIMEOUT = None
+BOOK_MEMORY_LIMIT = None
+SUPERVISOR_POLL_INTERVAL = 0.5
+COST_PNG_WEIGHT = 4
+COST_MEMBER_WEIGHT = 20000
+QUEUE_DB = None
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+
+current_member = None
+supervised_book = False
+
+def note_member(name):
+    global current_member
+    current_member = name
+
+def pool_workers(workers):
+    if PROFILE_TIME_BUDGET is not None:
+        return 1
+    if supervised_book:
+        return max(1, min(workers, (os.cpu_count() or 1) // BATCH_WORKERS))
+    return workers
+
+def append_journal(journal_path, event, book, **fields):
+    entry = {'event': event, 'book': book, 'time': time.time()}
+    entry.update(fields)
+    line = (json.dumps(entry) + '\n').encode('utf-8')
+    fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def load_journal(journal_path):
+    started = set()
+    finished = set()
+    if not os.path.exists(journal_path):
+        return finished, started
+    with open(journal_path, 'rb') as f:
+        data = f.read()
+    if data and not data.endswith(b'\n'):
+        with open(journal_path, 'ab') as f:
+            f.write(b'\n')
+    for line in data.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if entry.get('event') == 'start':
+            started.add(entry.get('book'))
+        elif entry.get('event') in ('done', 'failed'):
+            finished.add(entry.get('book'))
+    return finished, started - finished
+
+def cleanup_orphans(output_folder, in_flight):
+    for book in in_flight:
+        partial_output = os.path.join(output_folder, book)
+        if os.path.exists(partial_output + '.tmp'):
+            print(f"Removing orphaned temp file: {book}.tmp")
+            os.remove(partial_output + '.tmp')
+        if os.path.exists(partial_output):
+            print(f"Removing partial output of interrupted book: {book}")
+            os.remove(partial_output)
+
+def sample_stacks(thread_id, samples, stop):
+    while not stop.wait(PROFILE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            stack.append(f"member {current_member or '-'}")
+            samples[';'.join(reversed(stack))] += 1
+
+def save_profile(profile_path, samples):
+    os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+    with open(profile_path, 'w', encoding='utf-8') as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+
+def run_book(process_book, epub_file, output_path):
+    note_member(None)
+    samples = Counter()
+    stop = threading.Event()
+    sampler = None
+    if PROFILE_TIME_BUDGET is not None:
+        sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), samples, stop), daemon=True)
+        sampler.start()
+    start = time.perf_counter()
+    error = None
+    try:
+        process_book(epub_file, output_path)
+    except Exception as e:
+        print(f"\nFATAL ERROR processing {epub_file}:")
+        print(f"  {e}")
+        traceback.print_exc()
+        error = str(e)
+    elapsed = time.perf_counter() - start
+    profile_path = None
+    if sampler is not None:
+        stop.set()
+        sampler.join()
+        if elapsed > PROFILE_TIME_BUDGET and samples:
+            profile_folder = os.path.join(os.path.dirname(output_path), PROFILE_FOLDER_NAME)
+            profile_path = os.path.join(profile_folder, os.path.basename(epub_file) + '.collapsed')
+            save_profile(profile_path, samples)
+    return error, elapsed, profile_path
+
+def estimate_book_cost(epub_file):
+    try:
+        cost = os.path.getsize(epub_file)
+        with zipfile.ZipFile(epub_file, 'r') as zf:
+            infos = zf.infolist()
+    except (OSError, zipfile.BadZipFile):
+        return 0
+    png_bytes = sum(info.file_size for info in infos if info.filename.lower().endswith('.png'))
+    return cost + COST_PNG_WEIGHT * png_bytes + COST_MEMBER_WEIGHT * len(infos)
+
+def schedule_by_cost(epub_files):
+    costs = {epub_file: estimate_book_cost(epub_file) for epub_file in epub_files}
+    return sorted(epub_files, key=lambda epub_file: costs[epub_file], reverse=True)
+
+def book_worker(process_book, epub_file, output_path, connection):
+    global supervised_book
+    supervised_book = True
+    error, elapsed, profile_path = run_book(process_book, epub_file, output_path)
+    connection.send((error, profile_path))
+    connection.close()
+
+def child_pids(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, ValueError):
+        return []
+    descendants = list(children)
+    for child in children:
+        descendants.extend(child_pids(child))
+    return descendants
+
+def resident_memory(pid):
+    total = 0
+    for member_pid in [pid] + child_pids(pid):
+        try:
+            with open(f"/proc/{member_pid}/statm") as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            pass
+    return total
+
+def kill_worker(process):
+    for pid in child_pids(process.pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    process.kill()
+    process.join()
+
+def remove_partial_output(output_path):
+    for path in (output_path, output_path + '.tmp'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def finish_book(journal_path, results, book, output_path, error, elapsed, profile_path):
+    if error is None:
+        append_journal(journal_path, 'done', book, elapsed=round(elapsed, 3))
+    else:
+        remove_partial_output(output_path)
+        append_journal(journal_path, 'failed', book, error=error, elapsed=round(elapsed, 3))
+    results.append((book, error, elapsed, profile_path))
+
+def run_supervised(process_book, claim_next, finish, renew=None):
+    running = []
+    last_renewal = time.monotonic()
+    while True:
+        while len(running) < BATCH_WORKERS:
+            claimed = claim_next()
+            if claimed is None:
+                break
+            epub_file, output_path = claimed
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=book_worker, args=(process_book, epub_file, output_path, sender))
+            process.start()
+            sender.close()
+            running.append((process, receiver, epub_file, output_path, time.monotonic()))
+        if not running:
+            break
+        wait([process.sentinel for process, *_ in running], timeout=SUPERVISOR_POLL_INTERVAL)
+        still_running = []
+        for process, receiver, epub_file, output_path, start in running:
+            elapsed = time.monotonic() - start
+            error = None
+            profile_path = None
+            if not process.is_alive():
+                process.join()
+                try:
+                    error, profile_path = receiver.recv()
+                except EOFError:
+                    error = f"worker exited with code {process.exitcode}"
+            elif BOOK_TIMEOUT and elapsed > BOOK_TIMEOUT:
+                error = f"timed out after {BOOK_TIMEOUT}s"
+            elif BOOK_MEMORY_LIMIT and resident_memory(process.pid) > BOOK_MEMORY_LIMIT:
+                error = f"exceeded memory limit of {BOOK_MEMORY_LIMIT:,} bytes"
+            else:
+                still_running.append((process, receiver, epub_file, output_path, start))
+                continue
+            if process.is_alive():
+                print(f"\nKilled {os.path.basename(epub_file)}: {error}")
+                kill_worker(process)
+            receiver.close()
+            finish(epub_file, output_path, error, elapsed, profile_path)
+        running = still_running
+        if renew and running and time.monotonic() - last_renewal > LEASE_SECONDS / 3:
+            renew([epub_file for process, receiver, epub_file, *_ in running])
+            last_renewal = time.monotonic()
+
+def run_inline(process_book, claim_next, finish):
+    while True:
+        claimed = claim_next()
+        if claimed is None:
+            break
+        epub_file, output_path = claimed
+        error, elapsed, profile_path = run_book(process_book, epub_file, output_path)
+        finish(epub_file, output_path, error, elapsed, profile_path)
+
+def open_queue(db_path):
+    connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        path TEXT PRIMARY KEY,
+        output_path TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        cost INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        lease_until REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        started_at REAL,
+        finished_at REAL,
+        elapsed REAL,
+        input_size INTEGER,
+        output_size INTEGER,
+        error TEXT)''')
+    connection.execute('CREATE INDEX IF NOT EXISTS jobs_status_cost ON jobs (status, cost)')
+    return connection
+
+def enqueue_books(connection, epub_files, output_folder):
+    known = {row[0] for row in connection.execute('SELECT path FROM jobs')}
+    rows = []
+    for epub_file in epub_files:
+        path = os.path.abspath(epub_file)
+        if path in known:
+            continue
+        output_path = os.path.abspath(os.path.join(output_folder, os.path.basename(epub_file)))
+        rows.append((path, output_path, estimate_book_cost(epub_file), os.path.getsize(epub_file)))
+    if rows:
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany('INSERT OR IGNORE INTO jobs (path, output_path, cost, input_size) VALUES (?, ?, ?, ?)', rows)
+        connection.execute('COMMIT')
+    return len(rows)
+
+def claim_job(connection, worker):
+    now = time.time()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute("UPDATE jobs SET status = 'failed', error = 'lease expired too many times', finished_at = ? "
+                           "WHERE status = 'running' AND lease_until < ? AND attempts >= ?", (now, now, MAX_ATTEMPTS))
+        row = connection.execute("SELECT path, output_path, status FROM jobs "
+                                 "WHERE status = 'pending' OR (status = 'running' AND lease_until < ?) "
+                                 "ORDER BY cost DESC LIMIT 1", (now,)).fetchone()
+        if row is not None:
+            connection.execute("UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                               "started_at = ?, error = NULL WHERE path = ?", (worker, now + LEASE_SECONDS, now, row[0]))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    return row
+
+def renew_leases(connection, worker, paths):
+    connection.executemany('UPDATE jobs SET lease_until = ? WHERE path = ? AND worker = ?',
+                           [(time.time() + LEASE_SECONDS, path, worker) for path in paths])
+
+def finish_job(connection, worker, path, output_path, error, elapsed):
+    output_size = os.path.getsize(output_path) if os.path.exists(output_path) else None
+    connection.execute("UPDATE jobs SET status = ?, finished_at = ?, elapsed = ?, output_size = ?, error = ?, lease_until = NULL "
+                       "WHERE path = ? AND worker = ? AND status = 'running'",
+                       ('done' if error is None else 'failed', time.time(), elapsed, output_size, error, path, worker))
+
+def print_queue_summary(connection):
+    print("\nQueue status:")
+    for status, count, elapsed, input_size, output_size in connection.execute(
+            'SELECT status, COUNT(*), SUM(elapsed), SUM(input_size), SUM(output_size) FROM jobs GROUP BY status ORDER BY status'):
+        print(f"  {status}: {count} book(s), {elapsed or 0:.1f}s, {input_size or 0:,} -> {output_size or 0:,} bytes")
+
+def run_queue(epub_files, output_folder, process_book, results):
+    connection = open_queue(QUEUE_DB)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    added = enqueue_books(connection, epub_files, output_folder)
+    print(f"Queue {QUEUE_DB}: {added} new book(s) added, worker {worker}")
+    def claim_next():
+        row = claim_job(connection, worker)
+        if row is None:
+            return None
+        path, output_path, previous_status = row
+        if previous_status == 'running':
+            print(f"Reclaiming expired lease: {os.path.basename(path)}")
+            remove_partial_output(output_path)
+        return path, output_path
+    def finish(epub_file, output_path, error, elapsed, profile_path):
+        if error is not None:
+            remove_partial_output(output_path)
+        finish_job(connection, worker, epub_file, output_path, error, elapsed)
+        results.append((os.path.basename(epub_file), error, elapsed, profile_path))
+    def renew(paths):
+        renew_leases(connection, worker, paths)
+    run_supervised(process_book, claim_next, finish, renew)
+    print_queue_summary(connection)
+    connection.close()
+
+def print_run_summary(results):
+    failed = [book for book, error, elapsed, profile_path in results if error is not None]
+    print(f"\nFinished {len(results)} book(s), {len(failed)} failed")
+    outliers = [r for r in results if PROFILE_TIME_BUDGET is not None and r[2] > PROFILE_TIME_BUDGET]
+    if outliers:
+        print(f"Books over the {PROFILE_TIME_BUDGET}s time budget:")
+        for book, error, elapsed, profile_path in sorted(outliers, key=lambda r: r[2], reverse=True):
+            print(f"  {book}: {elapsed:.1f}s" + (f" (profile: {profile_path})" if profile_path else ""))
+
+def run_batch(epub_files, output_folder, process_book, stage):
+    if QUEUE_DB:
+        results = []
+        run_queue(epub_files, output_folder, process_book, results)
+        print_run_summary(results)
+        return results
+    journal_path = os.path.join(output_folder, JOURNAL_NAME.format(stage=stage))
+    finished, in_flight = load_journal(journal_path)
+    cleanup_orphans(output_folder, in_flight)
+    pending = schedule_by_cost([f for f in epub_files if os.path.basename(f) not in finished])
+    if len(pending) < len(epub_files):
+        print(f"Resuming from {journal_path}: {len(epub_files) - len(pending)} book(s) already done, {len(pending)} remaining")
+    results = []
+    def claim_next():
+        if not pending:
+            return None
+        epub_file = pending.pop(0)
+        book = os.path.basename(epub_file)
+        append_journal(journal_path, 'start', book)
+        return epub_file, os.path.join(output_folder, book)
+    def finish(epub_file, output_path, error, elapsed, profile_path):
+        finish_book(journal_path, results, os.path.basename(epub_file), output_path, error, elapsed, profile_path)
+    if BATCH_WORKERS > 1 or BOOK_TIMEOUT or BOOK_MEMORY_LIMIT:
+        run_supervised(process_book, claim_next, finish)
+    else:
+        run_inline(process_book, claim_next, finish)
+    print_run_summary(results)
+    return results
@@ -0,0 +1,114 @@
+import io
+import time
+from PIL import Image
+import convert_png
+from convert_png import flatten_to_white, process_image_to_jpeg
+from css_output import compact_declarations, serialize_rules
+
+IMAGE_SIZE = (2400, 3200)
+REPEATS = 5
+CSS_RULES = 5000
+
+def make_sample_images():
+    noise = Image.effect_noise(IMAGE_SIZE, 40)
+    rgb = Image.merge('RGB', (noise, noise.rotate(90, expand=False), noise.transpose(Image.FLIP_LEFT_RIGHT)))
+    gradient = Image.linear_gradient('L').resize(IMAGE_SIZE)
+    samples = {}
+    rgba = rgb.copy()
+    rgba.putalpha(gradient)
+    samples['RGBA transparent'] = rgba
+    opaque = rgb.copy()
+    opaque.putalpha(255)
+    samples['RGBA opaque'] = opaque
+    la = noise.copy()
+    la.putalpha(gradient)
+    samples['LA transparent'] = la
+    samples['P transparent'] = rgba.convert('P', palette=Image.ADAPTIVE)
+    samples['P transparent'].info['transparency'] = 0
+    samples['L'] = noise
+    encoded = {}
+    for label, img in samples.items():
+        output = io.BytesIO()
+        img.save(output, format='PNG', compress_level=1)
+        encoded[label] = output.getvalue()
+    return encoded
+
+def time_call(func, *args):
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def bench_flatten(encoded):
+    print(f"Flatten and encode, {IMAGE_SIZE[0]}x{IMAGE_SIZE[1]}, best of {REPEATS}")
+    for label, data in encoded.items():
+        decoded = Image.open(io.BytesIO(data))
+        decoded.load()
+        flatten_time, flat = time_call(lambda: flatten_to_white(decoded.copy()))
+        total_time, jpeg_data = time_call(process_image_to_jpeg, data)
+        print(f"  {label:<18} flatten {flatten_time * 1000:7.1f} ms  total {total_time * 1000:7.1f} ms  {flat.mode:<3} {len(jpeg_data):,} bytes")
+
+def bench_flatten_steps(encoded):
+    img = Image.open(io.BytesIO(encoded['RGBA transparent']))
+    img.load()
+    alpha = img.getchannel('A')
+    flat = Image.new('RGB', img.size, (255, 255, 255))
+    steps = {
+        'extract alpha': lambda: img.getchannel('A'),
+        'opaque check': lambda: alpha.getextrema(),
+        'white canvas': lambda: Image.new('RGB', img.size, (255, 255, 255)),
+        'masked paste': lambda: flat.paste(img, mask=alpha),
+    }
+    print(f"Flatten steps, RGBA transparent, best of {REPEATS}")
+    for label, step in steps.items():
+        elapsed, _ = time_call(step)
+        print(f"  {label:<14} {elapsed * 1000:7.1f} ms")
+
+def bench_profiles(encoded):
+    print(f"JPEG profiles, best of {REPEATS}")
+    original_profile = convert_png.JPEG_PROFILE
+    for profile in convert_png.JPEG_PROFILES:
+        convert_png.JPEG_PROFILE = profile
+        total_time = 0
+        total_bytes = 0
+        for data in encoded.values():
+            elapsed, jpeg_data = time_call(process_image_to_jpeg, data)
+            total_time += elapsed
+            total_bytes += len(jpeg_data)
+        print(f"  {profile:<10} {total_time * 1000:7.1f} ms  {total_bytes:,} bytes")
+    convert_png.JPEG_PROFILE = original_profile
+
+def make_sample_rules():
+    rules = []
+    for index in range(CSS_RULES):
+        declarations = [f"{box}-{side}: 0 !important" for box in ('margin', 'padding') for side in ('top', 'right', 'bottom', 'left')]
+        declarations += ["text-indent: 1.5em !important", f"font-size: {1 + index % 5 / 10}em", "color: #333", "color: #333"]
+        rules.append((f"div.chapter  p.c{index} ,  .note{index}", declarations))
+        if index % 10 == 0:
+            rules.append((f".empty{index}", []))
+    return rules
+
+def bench_css():
+    rules = make_sample_rules()
+    print(f"CSS serialization, {len(rules):,} rules, best of {REPEATS}")
+    for style in ('pretty', 'compact'):
+        def serialize_cold():
+            compact_declarations.cache_clear()
+            return serialize_rules(rules, style)
+        cold_time, css_text = time_call(serialize_cold)
+        warm_time, css_text = time_call(serialize_rules, rules, style)
+        print(f"  {style:<10} cold {cold_time * 1000:7.1f} ms  warm {warm_time * 1000:7.1f} ms  {len(css_text.encode('utf-8')):,} bytes")
+
+def main():
+    encoded = make_sample_images()
+    bench_flatten(encoded)
+    bench_flatten_steps(encoded)
+    bench_profiles(encoded)
+    bench_css()
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,69 @@
 import os
+import re
+import codecs
+import hashlib
 import zipfile
+import zlib
+import mimetypes
 import io
-from PIL import Image
+import warnings
+from PIL import ExifTags, Image, ImageChops, ImageOps, ImageStat
 from collections import defaultdict
+from batch_runner import note_member, run_batch, write_report
 
 epub_folder = "input_files"
 output_folder = "output_files"
+DRY_RUN = False
+DRY_RUN_REPORT = os.path.join(output_folder, "png_dry_run.csv")
+DRY_RUN_CLASSIFY_PIXELS = False
+ESTIMATED_JPEG_BYTES_PER_PIXEL = 0.15
+JPEG_PROFILES = {
+    'fast': {'quality': 80, 'optimize': False, 'progressive': False, 'subsampling': 2},
+    'balanced': {'quality': 85, 'optimize': True, 'progressive': False, 'subsampling': 2},
+    'smallest': {'quality': 72, 'optimize': True, 'progressive': True, 'subsampling': 2},
+}
+JPEG_PROFILE = 'balanced'
+JPEG_TARGET_BYTES = None
+JPEG_TARGET_SSIM = None
+QUALITY_SEARCH_RANGE = (30, 95)
+QUALITY_PROXY_SIZE = 512
+SSIM_TILES = 8
+MAX_IMAGE_SIZE = None
+MAX_IMAGE_PIXELS = 64000000
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+HIGH_BIT_DEPTH_MODES = ('I;16', 'I;16B', 'I;16L', 'I')
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+PNG_OPTIMIZE = True
+PNG_MAX_COLORS = 256
+PNG_COMPRESS_LEVEL = 9
+PNG_PREFERENCE = 1.0
+DEFLATE_LEVEL = 6
+STORED_EXTENSIONS = (
+    '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.woff', '.woff2',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.mp4', '.m4v', '.webm', '.avi', '.mov',
+    '.zip', '.epub'
+)
+COMPRESSIBILITY_SAMPLE = 65536
+COMPRESSIBILITY_RATIO = 0.9
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+warnings.simplefilter('error', Image.DecompressionBombWarning)
+MANIFEST_ITEM_PATTERN = re.compile(r'[ \t]*<(?:\w+:)?item\b[^>]*>(?:\s*</(?:\w+:)?item>)?[ \t]*\r?\n?')
+MANIFEST_ITEM_BYTES_PATTERN = re.compile(MANIFEST_ITEM_PATTERN.pattern.encode('ascii'))
+PNG_REFERENCE_PATTERN = re.compile(rb'\.png', re.IGNORECASE)
+FILENAME_CHARACTER_PATTERNS = {str: re.compile(r'[\w.-]'), bytes: re.compile(rb'[\w.\x80-\xff-]')}
+UTF_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+)
+BOMLESS_UTF16_PREFIXES = ((b'<\x00', 'utf-16-le'), (b'\x00<', 'utf-16-be'))
+WIDE_ENCODING_PREFIXES = tuple(bom for bom, encoding in UTF_BOMS if encoding != 'utf-8') + tuple(prefix for prefix, encoding in BOMLESS_UTF16_PREFIXES)
+ENCODING_SNIFF_BYTES = 1024
+DECLARED_ENCODING_PATTERN = re.compile(rb'''^\s*(?:<\?xml[^>]*?\bencoding\s*=\s*["']([\w.:-]+)|@charset\s+["']([\w.:-]+))''', re.IGNORECASE)
+META_CHARSET_PATTERN = re.compile(rb'''<meta\b[^>]*?\bcharset\s*=\s*["']?([\w.:-]+)''', re.IGNORECASE)
 
 def find_all_substrings(text, substring, case_sensitive=True):
     positions = []
@@ -32,6 +90,7 @@ def find_all_substrings(text, substring, case_sensitive=True):
 def replace_all_occurrences(text, old_str, new_str):
     if old_str not in text:
         return text, 0
+    filename_character = FILENAME_CHARACTER_PATTERNS[type(text)]
     parts = []
     last_end = 0
     count = 0
@@ -40,31 +99,227 @@ def replace_all_occurrences(text, old_str, new_str):
         pos = text.find(old_str, start)
         if pos == -1:
             break
+        if pos > 0 and filename_character.match(text, pos - 1):
+            start = pos + 1
+            continue
         parts.append(text[last_end:pos])
         parts.append(new_str)
         count += 1
         last_end = pos + len(old_str)
         start = pos + len(old_str)
     parts.append(text[last_end:])
-    return ''.join(parts), count
+    return text[:0].join(parts), count
+
+def flatten_palette(img):
+    palette = img.getpalette('RGB') or []
+    transparency = img.info.pop('transparency', None)
+    if transparency is not None:
+        if isinstance(transparency, int):
+            alphas = {transparency: 0}
+        else:
+            alphas = dict(enumerate(transparency))
+        for index, alpha in alphas.items():
+            start = index * 3
+            if alpha == 255 or start + 3 > len(palette):
+                continue
+            palette[start:start + 3] = [(c * alpha + 255 * (255 - alpha) + 127) // 255 for c in palette[start:start + 3]]
+        img.putpalette(palette, 'RGB')
+    if all(palette[i] == palette[i + 1] == palette[i + 2] for i in range(0, len(palette) - 2, 3)):
+        return img.convert('L')
+    return img.convert('RGB')
+
+def normalize_bit_depth(img):
+    if img.mode in HIGH_BIT_DEPTH_MODES:
+        return img.convert('I').point(lambda value: value / 256).convert('L')
+    return img
+
+def flatten_to_white(img):
+    img = normalize_bit_depth(img)
+    if img.mode == 'P':
+        return flatten_palette(img)
+    elif img.mode == 'PA':
+        img = img.convert('RGBA')
+    elif img.mode in ('L', 'RGB') and 'transparency' in img.info:
+        img = img.convert('LA' if img.mode == 'L' else 'RGBA')
+    if img.mode in ('RGBA', 'LA'):
+        flat_mode = 'L' if img.mode == 'LA' else 'RGB'
+        alpha = img.getchannel('A')
+        if alpha.getextrema()[0] == 255:
+            return img.convert(flat_mode)
+        flat = Image.new(flat_mode, img.size, 255 if flat_mode == 'L' else (255, 255, 255))
+        flat.paste(img, mask=alpha)
+        return flat
+    if img.mode == '1':
+        return img.convert('L')
+    if img.mode not in ('L', 'RGB'):
+        return img.convert('RGB')
+    return img
+
+def encode_jpeg(img, settings):
+    output = io.BytesIO()
+    img.save(output, format='JPEG', **settings)
+    return output.getvalue()
+
+def tile_ssim(x, y):
+    stat_x = ImageStat.Stat(x)
+    stat_y = ImageStat.Stat(y)
+    mean_x, mean_y = stat_x.mean[0], stat_y.mean[0]
+    var_x, var_y = stat_x.var[0], stat_y.var[0]
+    var_mid = ImageStat.Stat(ImageChops.add(x, y, scale=2.0)).var[0]
+    covariance = 2 * var_mid - (var_x + var_y) / 2
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    return ((2 * mean_x * mean_y + c1) * (2 * covariance + c2)) / ((mean_x ** 2 + mean_y ** 2 + c1) * (var_x + var_y + c2))
+
+def estimate_ssim(reference, candidate):
+    x = reference.convert('L')
+    y = candidate.convert('L')
+    width, height = x.size
+    tiles = min(SSIM_TILES, width, height)
+    scores = []
+    for row in range(tiles):
+        for col in range(tiles):
+            box = (col * width // tiles, row * height // tiles, (col + 1) * width // tiles, (row + 1) * height // tiles)
+            scores.append(tile_ssim(x.crop(box), y.crop(box)))
+    return sum(scores) / len(scores)
+
+def search_jpeg_quality(img, settings):
+    proxy = img.copy()
+    proxy.thumbnail((QUALITY_PROXY_SIZE, QUALITY_PROXY_SIZE))
+    scale = (img.width * img.height) / (proxy.width * proxy.height)
+    low, high = QUALITY_SEARCH_RANGE
+    quality = high
+    if JPEG_TARGET_BYTES:
+        lo, hi, found = low, high, low
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if len(encode_jpeg(proxy, {**settings, 'quality': mid})) * scale <= JPEG_TARGET_BYTES:
+                found = mid
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        quality = min(quality, found)
+    if JPEG_TARGET_SSIM:
+        lo, hi, found = low, high, high
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            candidate = Image.open(io.BytesIO(encode_jpeg(proxy, {**settings, 'quality': mid})))
+            if estimate_ssim(proxy, candidate) >= JPEG_TARGET_SSIM:
+                found = mid
+                hi = mid - 1
+            else:
+                lo = mid + 1
+        quality = min(quality, found)
+    return quality
+
+def fit_to_budget(size, max_size):
+    width, height = size
+    scale = min(max_size[0] / width, max_size[1] / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def image_pixels(data):
+    width, height = Image.open(io.BytesIO(data)).size
+    return width * height
+
+def needs_resize(img):
+    return bool(MAX_IMAGE_SIZE) and fit_to_budget(img.size, MAX_IMAGE_SIZE) != img.size
+
+def resize_to_budget(img):
+    if needs_resize(img):
+        return img.resize(fit_to_budget(img.size, MAX_IMAGE_SIZE), Image.LANCZOS, reducing_gap=3.0)
+    return img
+
+def oriented_size(img):
+    width, height = img.size
+    if img.getexif().get(ExifTags.Base.Orientation) in TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+def matching_icc_profile(icc_profile, mode):
+    if icc_profile and icc_profile[16:20] == (b'GRAY' if mode == 'L' else b'RGB '):
+        return icc_profile
+    return None
+
+def image_to_jpeg(img):
+    icc_profile = img.info.get('icc_profile')
+    img = resize_to_budget(flatten_to_white(img))
+    settings = dict(JPEG_PROFILES[JPEG_PROFILE])
+    if JPEG_TARGET_BYTES or JPEG_TARGET_SSIM:
+        settings['quality'] = search_jpeg_quality(img, settings)
+    icc_profile = matching_icc_profile(icc_profile, img.mode)
+    if icc_profile:
+        settings['icc_profile'] = icc_profile
+    return encode_jpeg(img, settings)
 
 def process_image_to_jpeg(data):
     img = Image.open(io.BytesIO(data))
-    if img.mode in ('RGBA', 'LA', 'PA', 'P'):
-        if 'A' in img.mode:
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1])
-            img = background
-        else:
-            img = img.convert('RGB')
-    elif img.mode != 'RGB':
-        img = img.convert('RGB')
+    if MAX_IMAGE_SIZE and img.format == 'JPEG':
+        size = oriented_size(img)
+        width, height = fit_to_budget(size, MAX_IMAGE_SIZE)
+        img.draft(img.mode, (width, height) if size == img.size else (height, width))
+    return image_to_jpeg(ImageOps.exif_transpose(img))
+
+def has_transparency(img):
+    if img.mode in ('RGBA', 'LA', 'PA'):
+        alpha = img.getchannel('A')
+    elif 'transparency' in img.info:
+        alpha = img.convert('RGBA').getchannel('A')
+    else:
+        return False
+    return alpha.getextrema()[0] < 255
+
+def classify_image(img):
+    if has_transparency(img):
+        return 'alpha'
+    if img.mode in ('1', 'P') or img.getcolors(PNG_MAX_COLORS) is not None:
+        return 'low-color'
+    return 'photo'
+
+def classify_header(img):
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        return 'alpha'
+    if img.mode in ('1', 'P'):
+        return 'low-color'
+    return 'photo'
+
+def encode_png(img):
     output = io.BytesIO()
-    img.save(output, format='JPEG', quality=85, optimize=True)
+    img.save(output, format='PNG', optimize=True, compress_level=PNG_COMPRESS_LEVEL)
     return output.getvalue()
 
+def image_to_png(img, kind):
+    img = normalize_bit_depth(img)
+    if kind != 'alpha':
+        img.info.pop('transparency', None)
+    if img.mode not in ('1', 'L', 'P', 'RGB', 'RGBA') or (img.mode in ('1', 'P') and needs_resize(img)):
+        img = img.convert('RGBA' if kind == 'alpha' else 'RGB')
+    elif img.mode == 'RGBA' and kind != 'alpha':
+        img = img.convert('RGB')
+    img = resize_to_budget(img)
+    if img.mode in ('L', 'RGB', 'RGBA'):
+        colors = img.getcolors(PNG_MAX_COLORS)
+        if colors is not None:
+            method = Image.Quantize.FASTOCTREE if img.mode == 'RGBA' else Image.Quantize.MEDIANCUT
+            paletted = img.quantize(len(colors), method=method, dither=Image.Dither.NONE)
+            if ImageChops.difference(paletted.convert(img.mode), img).getbbox() is None:
+                img = paletted
+    return encode_png(img)
+
+def process_png_image(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    img = normalize_bit_depth(img)
+    kind = classify_image(img) if PNG_OPTIMIZE else 'photo'
+    if kind == 'photo':
+        return 'JPEG', image_to_jpeg(img)
+    jpeg_data = image_to_jpeg(img.copy())
+    png_data = image_to_png(img, kind)
+    if len(data) <= len(png_data) and not needs_resize(img):
+        png_data = data
+    if len(png_data) <= len(jpeg_data) * PNG_PREFERENCE:
+        return 'PNG', png_data
+    return 'JPEG', jpeg_data
+
 def generate_replacement_variants(png_path):
     variants = set()
     variants.add(png_path)
@@ -114,33 +369,128 @@ def scan_for_png_references(text, png_filenames):
                 references[png_file].append((actual_text, pos))
     return references
 
-def replace_png_with_jpg_in_text(text, png_filenames):
+def as_text(value):
+    return value.decode('utf-8', errors='replace') if isinstance(value, bytes) else value
+
+def replace_png_with_jpg_in_text(text, png_filenames, renames=None):
+    slash, jpg_extension = ('/', '.jpg') if isinstance(text, str) else (b'/', b'.jpg')
     modified_text = text
     total_replacements = 0
     replacement_log = []
     for png_file in sorted(png_filenames, key=len, reverse=True):
-        jpg_file = png_file[:-4] + '.jpg'
-        base_png = png_file.split('/')[-1]
-        base_jpg = base_png[:-4] + '.jpg'
+        jpg_file = renames[png_file] if renames else png_file[:-4] + jpg_extension
+        base_png = png_file.split(slash)[-1]
+        base_jpg = jpg_file.split(slash)[-1]
         replacement_pairs = []
         if png_file in modified_text:
             replacement_pairs.append((png_file, jpg_file))
         if base_png in modified_text and base_png != png_file:
             replacement_pairs.append((base_png, base_jpg))
-        path_parts = png_file.split('/')
+        path_parts = png_file.split(slash)
         for i in range(len(path_parts)):
-            partial_png = '/'.join(path_parts[i:])
-            partial_jpg = partial_png[:-4] + '.jpg'
+            partial_png = slash.join(path_parts[i:])
+            partial_jpg = slash.join(path_parts[i:-1] + [base_jpg])
             if partial_png in modified_text and partial_png not in [p[0] for p in replacement_pairs]:
                 replacement_pairs.append((partial_png, partial_jpg))
         for old_ref, new_ref in replacement_pairs:
             new_text, count = replace_all_occurrences(modified_text, old_ref, new_ref)
             if count > 0:
-                replacement_log.append(f"    Replaced '{old_ref}' -> '{new_ref}' ({count} times)")
+                replacement_log.append(f"    Replaced '{as_text(old_ref)}' -> '{as_text(new_ref)}' ({count} times)")
                 modified_text = new_text
                 total_replacements += count
     return modified_text, total_replacements, replacement_log
 
+def detect_encoding(data):
+    for bom, encoding in UTF_BOMS:
+        if data.startswith(bom):
+            return encoding, bom
+    for prefix, encoding in BOMLESS_UTF16_PREFIXES:
+        if data.startswith(prefix):
+            return encoding, b''
+    head = data[:ENCODING_SNIFF_BYTES]
+    match = DECLARED_ENCODING_PATTERN.match(head) or META_CHARSET_PATTERN.search(head)
+    if match:
+        try:
+            encoding = codecs.lookup(match.group(match.lastindex).decode('ascii')).name
+        except LookupError:
+            return 'utf-8', b''
+        if not encoding.startswith(('utf-16', 'utf-32')):
+            return encoding, b''
+    return 'utf-8', b''
+
+def rewrite_png_references(data, renames, collapse_manifest=False):
+    if not data.startswith(WIDE_ENCODING_PREFIXES) and not PNG_REFERENCE_PATTERN.search(data):
+        return data, 0, []
+    encoding, bom = detect_encoding(data)
+    if encoding == 'utf-8':
+        text = data
+        renames = {old.encode('utf-8'): new.encode('utf-8') for old, new in renames.items()}
+    else:
+        text = data[len(bom):].decode(encoding)
+    modified_text, replacement_count, log = replace_png_with_jpg_in_text(text, list(renames), renames)
+    if collapse_manifest:
+        modified_text, dropped_items = collapse_duplicate_manifest_items(modified_text)
+        if dropped_items:
+            log.append(f"    Dropped {dropped_items} duplicate manifest item(s)")
+            replacement_count += dropped_items
+    if not replacement_count:
+        return data, 0, log
+    if encoding != 'utf-8':
+        log.append(f"    Re-encoded as {encoding}")
+        modified_text = bom + modified_text.encode(encoding)
+    return modified_text, replacement_count, log
+
+def find_duplicate_images(inf, png_files):
+    candidates = defaultdict(list)
+    for png_file in png_files:
+        info = inf.getinfo(png_file)
+        directory = png_file.rsplit('/', 1)[0] if '/' in png_file else ''
+        candidates[(directory, info.CRC, info.file_size)].append(png_file)
+    duplicates = {}
+    for group in candidates.values():
+        if len(group) < 2:
+            continue
+        first_by_digest = {}
+        for png_file in group:
+            digest = hashlib.sha256(inf.read(png_file)).digest()
+            if digest in first_by_digest:
+                duplicates[png_file] = first_by_digest[digest]
+            else:
+                first_by_digest[digest] = png_file
+    return duplicates
+
+def get_attribute(tag, name):
+    pattern = r'\b' + name + r'\s*=\s*(["\'])(.*?)\1'
+    if isinstance(tag, bytes):
+        pattern = pattern.encode('ascii')
+    match = re.search(pattern, tag, re.S)
+    return match.group(2) if match else None
+
+def collapse_duplicate_manifest_items(opf_text):
+    kept_ids = {}
+    replaced_ids = {}
+    def drop_repeated_item(match):
+        tag = match.group(0)
+        href = get_attribute(tag, 'href')
+        item_id = get_attribute(tag, 'id')
+        if href is None:
+            return tag
+        if href not in kept_ids:
+            kept_ids[href] = item_id
+            return tag
+        if item_id and kept_ids[href]:
+            replaced_ids[item_id] = kept_ids[href]
+        return tag[:0]
+    if isinstance(opf_text, bytes):
+        item_pattern, prefix, suffix = MANIFEST_ITEM_BYTES_PATTERN, rb'(\b(?:idref|content)\s*=\s*["\'])', rb'(["\'])'
+    else:
+        item_pattern, prefix, suffix = MANIFEST_ITEM_PATTERN, r'(\b(?:idref|content)\s*=\s*["\'])', r'(["\'])'
+    new_text = item_pattern.sub(drop_repeated_item, opf_text)
+    for old_id, new_id in replaced_ids.items():
+        new_text = re.sub(prefix + re.escape(old_id) + suffix,
+                          lambda m: m.group(1) + new_id + m.group(2), new_text)
+    return new_text, len(replaced_ids)
+
 def is_text_file(filename):
     text_extensions = [
         '.html', '.xhtml', '.htm', '.xml', '.css', '.opf', '.ncx',
@@ -165,12 +515,105 @@ def is_binary_file(filename):
             return True
     return False
 
+def choose_compression(filename, data):
+    if filename == 'mimetype' or filename.startswith('META-INF/'):
+        return zipfile.ZIP_STORED, None
+    lower_name = filename.lower()
+    if lower_name.endswith(STORED_EXTENSIONS):
+        return zipfile.ZIP_STORED, None
+    if is_text_file(filename):
+        return zipfile.ZIP_DEFLATED, DEFLATE_LEVEL
+    mime_type = mimetypes.guess_type(lower_name)[0] or ''
+    if mime_type.startswith(('audio/', 'video/')):
+        return zipfile.ZIP_STORED, None
+    sample = data[:COMPRESSIBILITY_SAMPLE]
+    if sample and len(zlib.compress(sample, 1)) > len(sample) * COMPRESSIBILITY_RATIO:
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, DEFLATE_LEVEL
+
+def analyze_epub(input_path):
+    stats = {
+        'book': os.path.basename(input_path),
+        'would_change': False,
+        'png_files': 0,
+        'png_bytes': 0,
+        'png_pixels': 0,
+        'pngs_to_jpeg': 0,
+        'pngs_likely_kept_as_png': 0,
+        'projected_jpeg_bytes': 0,
+        'jpeg_files_downscaled': 0,
+        'jpeg_bytes_downscaled': 0,
+        'projected_downscaled_bytes': 0,
+        'projected_bytes_saved': 0,
+        'text_files_changed': 0,
+    }
+    png_names = []
+    png_bytes_converted = 0
+    with zipfile.ZipFile(input_path, 'r') as inf:
+        infos = inf.infolist()
+        for info in infos:
+            lower_name = info.filename.lower()
+            if MAX_IMAGE_SIZE and lower_name.endswith(JPEG_EXTENSIONS):
+                try:
+                    with inf.open(info) as fp:
+                        size = oriented_size(Image.open(fp))
+                except Exception as e:
+                    print(f"  Could not read header of {info.filename}: {e}")
+                    continue
+                width, height = fit_to_budget(size, MAX_IMAGE_SIZE)
+                if (width, height) == size:
+                    continue
+                stats['jpeg_files_downscaled'] += 1
+                stats['jpeg_bytes_downscaled'] += info.file_size
+                stats['projected_downscaled_bytes'] += int(info.file_size * width * height / (size[0] * size[1]))
+                continue
+            if not lower_name.endswith('.png'):
+                continue
+            stats['png_files'] += 1
+            stats['png_bytes'] += info.file_size
+            try:
+                with inf.open(info) as fp:
+                    img = Image.open(fp)
+                    width, height = img.size
+                    if not PNG_OPTIMIZE:
+                        kind = 'photo'
+                    elif DRY_RUN_CLASSIFY_PIXELS:
+                        kind = classify_image(normalize_bit_depth(img))
+                    else:
+                        kind = classify_header(img)
+            except Exception as e:
+                print(f"  Could not read {info.filename}: {e}")
+                continue
+            stats['png_pixels'] += width * height
+            if MAX_IMAGE_SIZE:
+                width, height = fit_to_budget((width, height), MAX_IMAGE_SIZE)
+            estimated_jpeg_bytes = int(width * height * ESTIMATED_JPEG_BYTES_PER_PIXEL)
+            if kind != 'photo' and info.file_size <= estimated_jpeg_bytes * PNG_PREFERENCE:
+                stats['pngs_likely_kept_as_png'] += 1
+                continue
+            png_names.append(info.filename.split('/')[-1].encode('utf-8'))
+            stats['pngs_to_jpeg'] += 1
+            png_bytes_converted += info.file_size
+            stats['projected_jpeg_bytes'] += estimated_jpeg_bytes
+        if png_names:
+            for info in infos:
+                if not is_text_file(info.filename):
+                    continue
+                data = inf.read(info)
+                if any(name in data for name in png_names):
+                    stats['text_files_changed'] += 1
+    stats['projected_bytes_saved'] = (png_bytes_converted - stats['projected_jpeg_bytes']
+                                      + stats['jpeg_bytes_downscaled'] - stats['projected_downscaled_bytes'])
+    stats['would_change'] = stats['png_files'] > 0 or stats['jpeg_files_downscaled'] > 0
+    return stats
+
 def process_epub(input_path, output_path):
     temp_output = output_path + '.tmp'
     print(f"\n{'='*80}")
     print(f"Processing: {input_path}")
     print(f"{'='*80}")
     png_files = []
+    jpeg_files = []
     all_files = {}
     file_types = defaultdict(int)
     with zipfile.ZipFile(input_path, 'r') as inf:
@@ -182,6 +625,8 @@ def process_epub(input_path, output_path):
             if lower_name.endswith('.png'):
                 png_files.append(filename)
                 print(f"  Found PNG: {filename} ({info.file_size} bytes)")
+            elif MAX_IMAGE_SIZE and lower_name.endswith(JPEG_EXTENSIONS):
+                jpeg_files.append(filename)
             ext_start = lower_name.rfind('.')
             if ext_start != -1:
                 ext = lower_name[ext_start:]
@@ -191,58 +636,100 @@ def process_epub(input_path, output_path):
         print("\nFile type distribution:")
         for ext, count in sorted(file_types.items()):
             print(f"  {ext}: {count}")
-        if not png_files:
+        if not png_files and not jpeg_files:
             print("\nNo PNG files found - nothing to convert")
             return
+        duplicates = find_duplicate_images(inf, png_files)
+        if duplicates:
+            print(f"\nIdentical images found: {len(duplicates)} duplicate(s) will be collapsed")
+            for duplicate, original in sorted(duplicates.items()):
+                print(f"  {duplicate} == {original}")
         print(f"\n{'='*80}")
-        print("Step 2: Converting PNG images to JPEG...")
+        print("Step 2: Converting PNG images...")
         print(f"{'='*80}")
         converted_images = {}
         conversion_stats = []
         for png_file in png_files:
+            if png_file in duplicates:
+                continue
+            note_member(png_file)
             try:
                 png_data = inf.read(png_file)
-                jpeg_data = process_image_to_jpeg(png_data)
-                jpg_filename = png_file[:-4] + '.jpg'
+                original_pixels = image_pixels(png_data)
+                image_format, new_data = process_png_image(png_data)
+                new_filename = png_file[:-4] + '.jpg' if image_format == 'JPEG' else png_file
                 converted_images[png_file] = {
-                    'new_name': jpg_filename,
-                    'data': jpeg_data,
+                    'new_name': new_filename,
+                    'format': image_format,
+                    'data': new_data,
                     'original_size': len(png_data),
-                    'new_size': len(jpeg_data)
+                    'new_size': len(new_data)
                 }
-                reduction = len(png_data) - len(jpeg_data)
+                reduction = len(png_data) - len(new_data)
                 percent = (reduction / len(png_data) * 100) if len(png_data) > 0 else 0
                 print(f"  {png_file}")
-                print(f"    -> {jpg_filename}")
-                print(f"    Original: {len(png_data):,} bytes, JPEG: {len(jpeg_data):,} bytes")
+                print(f"    -> {new_filename}")
+                print(f"    Original: {len(png_data):,} bytes, {image_format}: {len(new_data):,} bytes")
                 print(f"    Reduction: {reduction:,} bytes ({percent:.1f}%)")
                 conversion_stats.append({
                     'file': png_file,
                     'original': len(png_data),
-                    'new': len(jpeg_data),
-                    'reduction': reduction
+                    'new': len(new_data),
+                    'reduction': reduction,
+                    'original_pixels': original_pixels,
+                    'new_pixels': image_pixels(new_data)
                 })
             except Exception as e:
                 print(f"  ERROR converting {png_file}: {e}")
                 import traceback
                 traceback.print_exc()
+        resized_images = {}
+        if jpeg_files:
+            print(f"\nDownscaling JPEG images larger than {MAX_IMAGE_SIZE[0]}x{MAX_IMAGE_SIZE[1]}...")
+        for jpeg_file in jpeg_files:
+            note_member(jpeg_file)
+            try:
+                original_data = inf.read(jpeg_file)
+                size = oriented_size(Image.open(io.BytesIO(original_data)))
+                if fit_to_budget(size, MAX_IMAGE_SIZE) == size:
+                    continue
+                resized_data = process_image_to_jpeg(original_data)
+                resized_images[jpeg_file] = resized_data
+                print(f"  {jpeg_file}: {len(original_data):,} -> {len(resized_data):,} bytes")
+                conversion_stats.append({
+                    'file': jpeg_file,
+                    'original': len(original_data),
+                    'new': len(resized_data),
+                    'reduction': len(original_data) - len(resized_data),
+                    'original_pixels': size[0] * size[1],
+                    'new_pixels': image_pixels(resized_data)
+                })
+            except Exception as e:
+                print(f"  ERROR downscaling {jpeg_file}: {e}")
+        if not png_files and not resized_images:
+            print("\nNo PNG or oversized JPEG files found - nothing to convert")
+            return
+        duplicates = {d: o for d, o in duplicates.items() if o in converted_images}
+        renames = {png_file: info['new_name'] for png_file, info in converted_images.items() if info['new_name'] != png_file}
+        for duplicate, original in duplicates.items():
+            renames[duplicate] = converted_images[original]['new_name']
         print(f"\n{'='*80}")
         print("Step 3: Scanning text files for PNG references...")
         print(f"{'='*80}")
         text_files_to_process = []
         for filename in all_files:
-            if is_text_file(filename):
+            if renames and is_text_file(filename):
                 text_files_to_process.append(filename)
         print(f"Found {len(text_files_to_process)} text files to scan")
         modified_text_files = {}
         total_text_replacements = 0
         for text_file in text_files_to_process:
+            note_member(text_file)
             try:
-                data = inf.read(text_file)
-                text = data.decode('utf-8', errors='replace')
-                modified_text, replacement_count, log = replace_png_with_jpg_in_text(text, png_files)
+                collapse_manifest = bool(duplicates) and text_file.lower().endswith('.opf')
+                modified_data, replacement_count, log = rewrite_png_references(inf.read(text_file), renames, collapse_manifest)
                 if replacement_count > 0:
-                    modified_text_files[text_file] = modified_text.encode('utf-8')
+                    modified_text_files[text_file] = modified_data
                     total_text_replacements += replacement_count
                     print(f"\n  {text_file}: {replacement_count} replacements")
                     for log_entry in log:
@@ -258,29 +745,29 @@ def process_epub(input_path, output_path):
             files_written = 0
             for info in inf.infolist():
                 filename = info.filename
-                if filename in png_files:
-                    jpg_info = converted_images[filename]
-                    new_filename = jpg_info['new_name']
-                    jpeg_data = jpg_info['data']
-                    compress_type = zipfile.ZIP_DEFLATED
-                    if filename == 'mimetype' or filename.startswith('META-INF/'):
-                        compress_type = zipfile.ZIP_STORED
-                    outf.writestr(new_filename, jpeg_data, compress_type=compress_type)
+                if filename in duplicates:
+                    print(f"  Dropped duplicate: {filename}")
+                elif filename in converted_images:
+                    image_info = converted_images[filename]
+                    new_filename = image_info['new_name']
+                    new_data = image_info['data']
+                    compress_type, level = choose_compression(new_filename, new_data)
+                    outf.writestr(new_filename, new_data, compress_type=compress_type, compresslevel=level)
                     files_written += 1
                     print(f"  Wrote: {new_filename}")
+                elif filename in resized_images:
+                    compress_type, level = choose_compression(filename, resized_images[filename])
+                    outf.writestr(filename, resized_images[filename], compress_type=compress_type, compresslevel=level)
+                    files_written += 1
                 elif filename in modified_text_files:
                     modified_data = modified_text_files[filename]
-                    compress_type = zipfile.ZIP_DEFLATED
-                    if filename == 'mimetype' or filename.startswith('META-INF/'):
-                        compress_type = zipfile.ZIP_STORED
-                    outf.writestr(filename, modified_data, compress_type=compress_type)
+                    compress_type, level = choose_compression(filename, modified_data)
+                    outf.writestr(filename, modified_data, compress_type=compress_type, compresslevel=level)
                     files_written += 1
                 else:
                     original_data = inf.read(filename)
-                    compress_type = zipfile.ZIP_DEFLATED
-                    if filename == 'mimetype' or filename.startswith('META-INF/'):
-                        compress_type = zipfile.ZIP_STORED
-                    outf.writestr(filename, original_data, compress_type=compress_type)
+                    compress_type, level = choose_compression(filename, original_data)
+                    outf.writestr(filename, original_data, compress_type=compress_type, compresslevel=level)
                     files_written += 1
             print(f"\nTotal files written to output: {files_written}")
     os.replace(temp_output, output_path)
@@ -289,7 +776,10 @@ def process_epub(input_path, output_path):
     print(f"{'='*80}")
     print(f"Input file: {input_path}")
     print(f"Output file: {output_path}")
-    print(f"PNG files converted: {len(converted_images)}")
+    print(f"PNG files converted to JPEG: {sum(1 for info in converted_images.values() if info['format'] == 'JPEG')}")
+    print(f"PNG files kept as PNG: {sum(1 for info in converted_images.values() if info['format'] == 'PNG')}")
+    print(f"JPEG files downscaled: {len(resized_images)}")
+    print(f"Duplicate images collapsed: {len(duplicates)} ({sum(all_files[d].file_size for d in duplicates):,} bytes)")
     print(f"Text files modified: {len(modified_text_files)}")
     print(f"Total string replacements: {total_text_replacements}")
     if conversion_stats:
@@ -299,8 +789,11 @@ def process_epub(input_path, output_path):
         percent_saved = (total_saved / total_original * 100) if total_original > 0 else 0
         print(f"\nImage size reduction:")
         print(f"  Original total: {total_original:,} bytes")
-        print(f"  JPEG total: {total_new:,} bytes")
+        print(f"  New total: {total_new:,} bytes")
         print(f"  Space saved: {total_saved:,} bytes ({percent_saved:.1f}%)")
+        original_pixels = sum(s['original_pixels'] for s in conversion_stats)
+        new_pixels = sum(s['new_pixels'] for s in conversion_stats)
+        print(f"  Pixels: {original_pixels:,} -> {new_pixels:,} ({original_pixels - new_pixels:,} saved)")
     input_size = os.path.getsize(input_path)
     output_size = os.path.getsize(output_path)
     epub_saved = input_size - output_size
@@ -322,16 +815,20 @@ def main():
         print(f"No EPUB files found in '{epub_folder}'.")
         return
     print(f"Found {len(epub_files)} EPUB file(s) to process")
-    for epub_file in epub_files:
-        epub_filename = os.path.basename(epub_file)
-        output_path = os.path.join(output_folder, epub_filename)
-        try:
-            process_epub(epub_file, output_path)
-        except Exception as e:
-            print(f"\nFATAL ERROR processing {epub_file}:")
-            print(f"  {e}")
-            import traceback
-            traceback.print_exc()
+    if DRY_RUN:
+        rows = []
+        for epub_file in epub_files:
+            try:
+                stats = analyze_epub(epub_file)
+            except Exception as e:
+                print(f"Failed to analyze {epub_file}: {e}")
+                continue
+            print(f"{stats['book']}: {stats['pngs_to_jpeg']} PNG(s) to JPEG, {stats['pngs_likely_kept_as_png']} likely kept as PNG, "
+                  f"{stats['jpeg_files_downscaled']} JPEG(s) downscaled, ~{stats['projected_bytes_saved']:,} bytes saved")
+            rows.append(stats)
+        write_report(rows, DRY_RUN_REPORT)
+        return
+    run_batch(epub_files, output_folder, process_epub, "convert_png")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,77 @@
+from functools import lru_cache
+
+DECLARATION_CACHE_SIZE = 65536
+BOX_PROPERTIES = ('margin', 'padding')
+BOX_SIDES = ('top', 'right', 'bottom', 'left')
+
+def split_declaration(decl):
+    prop, value = decl.split(':', 1)
+    return prop.strip(), value.strip()
+
+def minify_selector(selector):
+    if '"' in selector or "'" in selector:
+        return selector.strip()
+    return ','.join(' '.join(part.split()) for part in selector.split(','))
+
+def minify_value(value):
+    if '"' in value or "'" in value:
+        return value
+    return ' '.join(value.split()).replace(' !important', '!important')
+
+def collapse_box_longhands(pairs):
+    names = [prop.lower() if prop is not None else '' for prop, value in pairs]
+    for box in BOX_PROPERTIES:
+        longhands = {}
+        others = False
+        for index, name in enumerate(names):
+            if box not in name:
+                continue
+            side = name[len(box) + 1:] if name.startswith(box + '-') else None
+            if side in BOX_SIDES and side not in longhands:
+                longhands[side] = index
+            else:
+                others = True
+        if others or len(longhands) != len(BOX_SIDES):
+            continue
+        indexes = set(longhands.values())
+        if len({pairs[index][1] for index in indexes}) != 1:
+            continue
+        first = min(indexes)
+        shorthand = (box, pairs[first][1])
+        pairs = [shorthand if index == first else pair for index, pair in enumerate(pairs) if index == first or index not in indexes]
+        names = [name for index, name in enumerate(names) if index == first or index not in indexes]
+    return pairs
+
+@lru_cache(maxsize=DECLARATION_CACHE_SIZE)
+def compact_declarations(declarations):
+    pairs = []
+    for decl in declarations:
+        if ':' in decl:
+            prop, value = split_declaration(decl)
+            pair = (prop, minify_value(value))
+        else:
+            pair = (None, decl)
+        if not pairs or pairs[-1] != pair:
+            pairs.append(pair)
+    pairs = collapse_box_longhands(pairs)
+    return ';'.join(value if prop is None else f"{prop}:{value}" for prop, value in pairs)
+
+def serialize_declarations(declarations, style='pretty'):
+    if style == 'compact':
+        return compact_declarations(tuple(declarations))
+    return '; '.join(declarations)
+
+def serialize_rules(rules, style='pretty'):
+    output = []
+    if style == 'compact':
+        for selector, declarations in rules:
+            declarations = compact_declarations(tuple(declarations))
+            if declarations:
+                output.append(f"{minify_selector(selector)}{{{declarations}}}")
+        return ''.join(output)
+    for selector, declarations in rules:
+        output.append(f"{selector} {{")
+        for decl in declarations:
+            output.append(f"    {decl};")
+        output.append("}")
+    return '\n'.join(output)
@@ -1,16 +1,49 @@
 import os
+import re
 import shutil
+import zipfile
+import posixpath
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from urllib.parse import unquote
 from calibre.ebooks.oeb.polish.container import get_container
 from lxml import etree, html
+from batch_runner import note_member, pool_workers, run_batch, write_report
+from convert_png import detect_encoding
+from css_output import serialize_declarations, serialize_rules
 
 epub_folder = "input_files"
 output_folder = "output_files"
+DRY_RUN = False
+DRY_RUN_REPORT = os.path.join(output_folder, "margin_dry_run.csv")
+MEMBER_WORKERS = os.cpu_count() or 1
+PARALLEL_SIZE_THRESHOLD = 2000000
+STYLE_CACHE_SIZE = 65536
+CSS_OUTPUT_STYLE = "pretty"
+PROMOTE_INLINE_STYLES = False
+PROMOTE_MIN_COUNT = 20
+PROMOTED_STYLESHEET = "promoted_styles.css"
+PROMOTED_CLASS_PREFIX = "erm-s"
 HEADER_SELECTORS = {
     'h1', 'h2', 'h3', 'h4', 'h5', 'h6', '.h1', '.h2', '.h3', '.h4', '.h5', '.h6',
     '.chapter-title', '.section-title', '.title', '.ch-title', '.ch-num'}
 
 QUOTE_SELECTORS = {'blockquote', '.blockquote', '.quote', '.epigraph'}
 
+CSS_EXTENSIONS = ('.css',)
+HTML_EXTENSIONS = ('.xhtml', '.html', '.htm', '.xht')
+PAGE_TEMPLATE_EXTENSIONS = ('.xpgt',)
+MEDIA_TYPE_KINDS = {
+    'text/css': 'css',
+    'application/xhtml+xml': 'html',
+    'text/html': 'html',
+    'application/vnd.adobe-page-template+xml': 'page-template',
+}
+CONTAINER_NAME = 'META-INF/container.xml'
+STYLE_PATTERN = re.compile(r'style', re.IGNORECASE)
+STYLE_ATTRIBUTE_PATTERN = re.compile(r'\sstyle\s*=\s*(["\'])(.*?)\1', re.IGNORECASE | re.DOTALL)
+
 def get_exemption_type(selector):
     selector_lower = selector.lower().strip()
     for quote_sel in QUOTE_SELECTORS:
@@ -135,6 +168,15 @@ def parse_css_rules(tokens):
             i += 1
     return rules
 
+def declaration_text(decl):
+    if ':' not in decl:
+        return decl
+    prop, value = decl.split(':', 1)
+    value = value.strip()
+    if value.endswith(';'):
+        value = value[:-1].strip()
+    return f"{prop.strip()}: {value}"
+
 def process_declaration(decl, exempt_type):
     if ':' not in decl:
         return decl
@@ -159,33 +201,62 @@ def process_declaration(decl, exempt_type):
         return f"{prop}: {new_value} !important"
     return f"{prop}: {value}"
 
-def process_css_rules_list(rules):
+def process_css_rules_list(rules, stats=None):
     output = []
     for rule in rules:
         if rule['type'] == 'rule':
             selector = rule['selector']
             exempt_type = get_exemption_type(selector)
-            output.append(f"{selector} {{")
+            processed_decls = []
             for decl in rule['declarations']:
                 processed = process_declaration(decl, exempt_type)
-                output.append(f"    {processed};")
-            output.append("}")
-    return '\n'.join(output)
+                if stats is not None and processed != declaration_text(decl):
+                    stats['declarations_rewritten'] += 1
+                processed_decls.append(processed)
+            output.append((selector, processed_decls))
+    return serialize_rules(output, CSS_OUTPUT_STYLE)
 
-def replace_margins_in_css(css_content):
+def replace_margins_in_css(css_content, stats=None):
     tokens = tokenize_css(css_content)
     rules = parse_css_rules(tokens)
-    return process_css_rules_list(rules)
+    return process_css_rules_list(rules, stats)
 
-def process_style_element(style_elem):
+def process_style_element(style_elem, stats=None):
     if style_elem.text:
         original = style_elem.text
-        processed = replace_margins_in_css(original)
+        processed = replace_margins_in_css(original, stats)
         style_elem.text = processed
         return original != processed
     return False
 
-def process_style_attribute(elem):
+@lru_cache(maxsize=STYLE_CACHE_SIZE)
+def get_element_exemption_type(tag_name, elem_class):
+    if tag_name == 'blockquote':
+        return 'quote'
+    if tag_name in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+        return 'header'
+    elem_class = elem_class.lower()
+    for quote_sel in QUOTE_SELECTORS:
+        if quote_sel.startswith('.') and quote_sel[1:] in elem_class:
+            return 'quote'
+    for header_sel in HEADER_SELECTORS:
+        if header_sel.startswith('.') and header_sel[1:] in elem_class:
+            return 'header'
+    return None
+
+@lru_cache(maxsize=STYLE_CACHE_SIZE)
+def rewrite_style_attribute(style_attr, exempt_type):
+    declarations = [d.strip() for d in style_attr.split(';') if d.strip()]
+    processed_decls = []
+    rewritten = 0
+    for decl in declarations:
+        processed = process_declaration(decl, exempt_type)
+        if processed != declaration_text(decl):
+            rewritten += 1
+        processed_decls.append(processed)
+    return serialize_declarations(processed_decls, CSS_OUTPUT_STYLE), rewritten
+
+def process_style_attribute(elem, stats=None):
     style_attr = elem.get('style')
     if not style_attr:
         return False
@@ -193,90 +264,293 @@ def process_style_attribute(elem):
     tag_name = elem.tag.lower() if isinstance(elem.tag, str) else ''
     if '}' in tag_name:
         tag_name = tag_name.split('}')[-1]
-    exempt_type = None
-    if tag_name == 'blockquote':
-        exempt_type = 'quote'
-    elif tag_name in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
-        exempt_type = 'header'
-    else:
-        elem_class = elem.get('class', '')
-        for quote_sel in QUOTE_SELECTORS:
-            if quote_sel.startswith('.') and quote_sel[1:] in elem_class.lower():
-                exempt_type = 'quote'
-                break
-        if not exempt_type:
-            for header_sel in HEADER_SELECTORS:
-                if header_sel.startswith('.') and header_sel[1:] in elem_class.lower():
-                    exempt_type = 'header'
-                    break
-    declarations = [d.strip() for d in style_attr.split(';') if d.strip()]
-    processed_decls = []
-    for decl in declarations:
-        processed = process_declaration(decl, exempt_type)
-        processed_decls.append(processed)
-    new_style = '; '.join(processed_decls)
+    exempt_type = get_element_exemption_type(tag_name, elem.get('class', ''))
+    new_style, rewritten = rewrite_style_attribute(style_attr, exempt_type)
+    if stats is not None:
+        stats['declarations_rewritten'] += rewritten
+    if original == new_style:
+        return False
     elem.set('style', new_style)
-    return original != new_style
+    return True
+
+def parse_html_tree(html_content):
+    try:
+        return html.fromstring(html_content)
+    except:
+        try:
+            parser = etree.XMLParser(recover=True, encoding='utf-8')
+            return etree.fromstring(html_content.encode('utf-8'), parser)
+        except:
+            return None
 
-def process_html_content(html_content):
+def serialize_html_tree(tree):
     try:
-        tree = html.fromstring(html_content)
+        return html.tostring(tree, encoding='unicode', method='html')
     except:
         try:
-            parser = etree.XMLParser(recover=True)
-            tree = etree.fromstring(html_content.encode('utf-8'), parser)
+            return etree.tostring(tree, encoding='unicode', method='xml')
         except:
-            return html_content, False
+            return None
+
+def process_html_content(html_content, stats=None):
+    tree = parse_html_tree(html_content)
+    if tree is None:
+        return html_content, False
     modified = False
     for style_elem in tree.xpath('//style'):
-        if process_style_element(style_elem):
+        if process_style_element(style_elem, stats):
             modified = True
     for elem in tree.xpath('//*[@style]'):
-        if process_style_attribute(elem):
+        if process_style_attribute(elem, stats):
             modified = True
     if modified:
-        try:
-            result = html.tostring(tree, encoding='unicode', method='html')
+        result = serialize_html_tree(tree)
+        if result is not None:
             return result, True
-        except:
-            try:
-                result = etree.tostring(tree, encoding='unicode', method='xml')
-                return result, True
-            except:
-                return html_content, False
     return html_content, False
 
+def find_head(tree):
+    heads = tree.xpath('//*[local-name()="head"]')
+    return heads[0] if heads else None
+
+def parse_promotable_tree(html_content):
+    if not STYLE_ATTRIBUTE_PATTERN.search(html_content):
+        return None
+    tree = parse_html_tree(html_content)
+    if tree is None or find_head(tree) is None:
+        return None
+    return tree
+
+def count_inline_styles(trees):
+    counts = Counter()
+    for tree in trees:
+        for elem in tree.xpath('//*[@style]'):
+            style_attr = elem.get('style').strip()
+            if style_attr:
+                counts[style_attr] += 1
+    return counts
+
+def build_promoted_classes(style_counts):
+    class_map = {}
+    for style_attr, count in style_counts.most_common():
+        if count < PROMOTE_MIN_COUNT:
+            break
+        class_map[style_attr] = f"{PROMOTED_CLASS_PREFIX}{len(class_map) + 1}"
+    return class_map
+
+def build_promoted_stylesheet(class_map):
+    rules = []
+    for style_attr, class_name in class_map.items():
+        declarations = []
+        for decl in style_attr.split(';'):
+            decl = declaration_text(decl.strip())
+            if not decl:
+                continue
+            if not decl.endswith('!important'):
+                decl += ' !important'
+            declarations.append(decl)
+        rules.append((f".{class_name}", declarations))
+    return serialize_rules(rules, CSS_OUTPUT_STYLE)
+
+def promote_styles_in_tree(tree, class_map, stylesheet_href):
+    modified = False
+    for elem in tree.xpath('//*[@style]'):
+        class_name = class_map.get(elem.get('style').strip())
+        if not class_name:
+            continue
+        existing = elem.get('class')
+        elem.set('class', f"{existing} {class_name}" if existing else class_name)
+        del elem.attrib['style']
+        modified = True
+    if not modified:
+        return None
+    head = find_head(tree)
+    namespace = etree.QName(head).namespace
+    link_tag = f"{{{namespace}}}link" if namespace else 'link'
+    head.append(head.makeelement(link_tag, {'rel': 'stylesheet', 'type': 'text/css', 'href': stylesheet_href}))
+    return serialize_html_tree(tree)
+
+def promote_inline_styles(container, html_items):
+    trees = []
+    for name, html_content in html_items:
+        tree = parse_promotable_tree(html_content)
+        if tree is not None:
+            trees.append((name, tree))
+    class_map = build_promoted_classes(count_inline_styles(tree for name, tree in trees))
+    if not class_map:
+        return False
+    css_name = posixpath.join(posixpath.dirname(container.opf_name), PROMOTED_STYLESHEET)
+    promoted = []
+    for name, tree in trees:
+        new_content = promote_styles_in_tree(tree, class_map, container.name_to_href(css_name, name))
+        if new_content is not None:
+            promoted.append((name, new_content))
+    if not promoted:
+        return False
+    css_text = build_promoted_stylesheet(class_map)
+    if container.has_name(css_name):
+        container.replace(css_name, css_text)
+    else:
+        container.add_file(css_name, css_text.encode('utf-8'), media_type='text/css')
+    for name, new_content in promoted:
+        container.replace(name, new_content)
+    print(f"Promoted {len(class_map)} repeated inline style(s) in {len(promoted)} chapter(s) to {css_name}")
+    return True
+
+def get_member_kind(filename):
+    lower_name = filename.lower()
+    if lower_name.endswith(CSS_EXTENSIONS):
+        return 'css'
+    if lower_name.endswith(HTML_EXTENSIONS):
+        return 'html'
+    if lower_name.endswith(PAGE_TEMPLATE_EXTENSIONS):
+        return 'page-template'
+    return None
+
+def read_member_kinds(zf):
+    try:
+        container = etree.fromstring(zf.read(CONTAINER_NAME))
+        opf_name = container.xpath('//*[local-name()="rootfile"]/@full-path')[0]
+        opf = etree.fromstring(zf.read(opf_name), etree.XMLParser(recover=True))
+    except Exception:
+        return None
+    if opf is None:
+        return None
+    member_kinds = {name: get_member_kind(name) for name in zf.namelist()}
+    opf_dir = posixpath.dirname(opf_name)
+    for item in opf.xpath('//*[local-name()="manifest"]/*[local-name()="item"][@href]'):
+        name = posixpath.normpath(posixpath.join(opf_dir, unquote(item.get('href').split('#')[0])))
+        if name in member_kinds:
+            member_kinds[name] = MEDIA_TYPE_KINDS.get(item.get('media-type', '').strip().lower())
+    return member_kinds
+
+def decode_text(data):
+    encoding, bom = detect_encoding(data)
+    try:
+        return data[len(bom):].decode(encoding)
+    except (UnicodeDecodeError, LookupError):
+        return None
+
+def analyze_epub(input_path):
+    stats = {
+        'book': os.path.basename(input_path),
+        'would_change': False,
+        'members_scanned': 0,
+        'css_files_changed': 0,
+        'html_files_changed': 0,
+        'page_templates_removed': 0,
+        'declarations_rewritten': 0,
+        'projected_bytes_saved': 0,
+    }
+    with zipfile.ZipFile(input_path, 'r') as zf:
+        for info in zf.infolist():
+            kind = get_member_kind(info.filename)
+            if kind is None:
+                continue
+            stats['members_scanned'] += 1
+            if kind == 'page-template':
+                stats['page_templates_removed'] += 1
+                stats['projected_bytes_saved'] += info.file_size
+                continue
+            data = zf.read(info)
+            text = data.decode('utf-8', errors='replace')
+            if kind == 'css':
+                new_text = replace_margins_in_css(text, stats)
+                changed = new_text != text
+                if changed:
+                    stats['css_files_changed'] += 1
+            elif STYLE_PATTERN.search(text):
+                new_text, changed = process_html_content(text, stats)
+                if changed:
+                    stats['html_files_changed'] += 1
+            else:
+                changed = False
+            if changed:
+                stats['projected_bytes_saved'] += len(data) - len(new_text.encode('utf-8'))
+    stats['would_change'] = bool(stats['css_files_changed'] or stats['html_files_changed'] or stats['page_templates_removed'])
+    return stats
+
+def needs_changes(input_path):
+    style_counts = Counter()
+    with zipfile.ZipFile(input_path, 'r') as zf:
+        member_kinds = read_member_kinds(zf)
+        if member_kinds is None:
+            return True
+        for info in zf.infolist():
+            kind = member_kinds.get(info.filename)
+            if kind is None:
+                continue
+            note_member(info.filename)
+            if kind == 'page-template':
+                return True
+            text = decode_text(zf.read(info))
+            if text is None:
+                return True
+            if kind == 'css':
+                if replace_margins_in_css(text) != text:
+                    return True
+            elif STYLE_PATTERN.search(text):
+                if process_html_content(text)[1]:
+                    return True
+                if PROMOTE_INLINE_STYLES:
+                    tree = parse_promotable_tree(text)
+                    if tree is not None:
+                        style_counts.update(count_inline_styles([tree]))
+    return bool(build_promoted_classes(style_counts))
+
+def transform_member(job):
+    name, kind, text = job
+    note_member(name)
+    if kind == 'css':
+        new_text = replace_margins_in_css(text)
+        return new_text, new_text != text
+    return process_html_content(text)
+
+def transform_members(jobs):
+    total_size = sum(len(text) for name, kind, text in jobs)
+    workers = pool_workers(MEMBER_WORKERS)
+    if workers < 2 or len(jobs) < 2 or total_size < PARALLEL_SIZE_THRESHOLD:
+        return [transform_member(job) for job in jobs]
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(transform_member, jobs, chunksize=chunksize))
+
 def process_epub(input_path, output_path):
-    shutil.copy(input_path, output_path)
     try:
+        if not needs_changes(input_path):
+            print(f"No CSS changes needed in: {output_path}")
+            return
+        shutil.copy(input_path, output_path)
         container = get_container(output_path)
         modified = False
+        jobs = []
         for name, mt in list(container.mime_map.items()):
             if mt == "application/vnd.adobe-page-template+xml":
                 container.remove_item(name)
                 modified = True
             elif mt == "text/css":
-                css_text = container.raw_data(name, decode=True)
-                new_css_text = replace_margins_in_css(css_text)
-                if new_css_text != css_text:
-                    container.replace(name, new_css_text)
-                    modified = True
+                jobs.append((name, 'css', container.raw_data(name, decode=True)))
             elif mt in ("application/xhtml+xml", "text/html"):
-                html_content = container.raw_data(name, decode=True)
-                new_content, content_modified = process_html_content(html_content)
-                if content_modified:
-                    container.replace(name, new_content)
-                    modified = True
+                jobs.append((name, 'html', container.raw_data(name, decode=True)))
+        html_items = []
+        for (name, kind, text), (new_text, content_modified) in zip(jobs, transform_members(jobs)):
+            if content_modified:
+                container.replace(name, new_text)
+                modified = True
+            if kind == 'html':
+                html_items.append((name, new_text))
+        if PROMOTE_INLINE_STYLES and promote_inline_styles(container, html_items):
+            modified = True
         if modified:
             container.commit()
             print(f"Processed and saved: {output_path}")
         else:
             print(f"No CSS changes needed in: {output_path}")
             os.remove(output_path)
-    except Exception as e:
-        print(f"Failed to process {output_path}: {e}")
+    except Exception:
         if os.path.exists(output_path):
             os.remove(output_path)
+        raise
 
 def main():
     print('Run as: calibre-debug reduce_all_margins.py')
@@ -289,10 +563,19 @@ def main():
     if not epub_files:
         print(f"No EPUB files found in '{epub_folder}'.")
         return
-    for epub_file in epub_files:
-        epub_filename = os.path.basename(epub_file)
-        output_path = os.path.join(output_folder, epub_filename)
-        process_epub(epub_file, output_path)
+    if DRY_RUN:
+        rows = []
+        for epub_file in epub_files:
+            try:
+                stats = analyze_epub(epub_file)
+            except Exception as e:
+                print(f"Failed to analyze {epub_file}: {e}")
+                continue
+            print(f"{stats['book']}: {stats['declarations_rewritten']} declarations, {stats['projected_bytes_saved']:,} bytes")
+            rows.append(stats)
+        write_report(rows, DRY_RUN_REPORT)
+        return
+    run_batch(epub_files, output_folder, process_epub, "reduce_all_margins")
 
 if __name__ == "__main__":
     main()
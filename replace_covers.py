@@ -3,6 +3,7 @@ import sys
 from calibre.ebooks.oeb.polish.container import get_container
 from lxml import etree
 import shutil
+from batch_runner import run_batch
 
 epub_folder = input('Folder with EPUB files: ').rstrip("/")
 covers_folder = epub_folder + '_covers'
@@ -50,10 +51,22 @@ def process_epub(epub_path, output_path, replacement_path):
         container.replace(cover_name, new_cover_data)
         container.commit()
         print(f"Replaced cover in {os.path.basename(output_path)}")
-    except Exception as e:
-        print(f"Failed to process {os.path.basename(epub_path)}: {e}")
+    except Exception:
         if os.path.exists(output_path):
             os.remove(output_path)
+        raise
+
+def find_replacement_path(epub_path):
+    epub_stem = os.path.splitext(os.path.basename(epub_path))[0]
+    replacement_path = os.path.join(covers_folder, epub_stem + '.jpg')
+    if not os.path.exists(replacement_path):
+        replacement_path = os.path.join(covers_folder, epub_stem + '.png')
+    if not os.path.exists(replacement_path):
+        return None
+    return replacement_path
+
+def replace_cover(epub_path, output_path):
+    process_epub(epub_path, output_path, find_replacement_path(epub_path))
 
 def main():
     if not os.path.isdir(epub_folder):
@@ -71,22 +84,20 @@ def main():
     if not epub_files:
         print("No EPUB files found")
         return
-    success_count = 0
+    books_with_covers = []
     skip_count = 0
     for epub_path in epub_files:
-        epub_basename = os.path.basename(epub_path)
-        epub_stem = os.path.splitext(epub_basename)[0]
-        replacement_path = os.path.join(covers_folder, epub_stem + '.jpg')
-        if not os.path.exists(replacement_path):
-            replacement_path = os.path.join(covers_folder, epub_stem + '.png')
-        if not os.path.exists(replacement_path):
-            print(f"No replacement image found for {epub_basename}, skipping")
+        if find_replacement_path(epub_path) is None:
+            print(f"No replacement image found for {os.path.basename(epub_path)}, skipping")
             skip_count += 1
             continue
-        output_path = os.path.join(output_folder, epub_basename)
-        process_epub(epub_path, output_path, replacement_path)
-        success_count += 1
-    print(f"\nProcessed {len(epub_files)} files: {success_count} covers replaced, {skip_count} skipped")
+        books_with_covers.append(epub_path)
+    results = run_batch(books_with_covers, output_folder, replace_cover, "replace_covers")
+    failed_count = sum(1 for book, error, elapsed, profile_path in results if error is not None)
+    replaced_count = sum(1 for book, error, elapsed, profile_path in results
+                         if error is None and os.path.exists(os.path.join(output_folder, book)))
+    skip_count += len(results) - failed_count - replaced_count
+    print(f"\nProcessed {len(epub_files)} files: {replaced_count} covers replaced, {failed_count} failed, {skip_count} skipped")
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,25 @@
 import os
+import re
 import shutil
+import zipfile
+import posixpath
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from urllib.parse import unquote
 from lxml import html, etree
 from calibre.ebooks.oeb.polish.container import get_container
+from batch_runner import note_member, pool_workers, run_batch, write_report
+from convert_png import detect_encoding
+from css_output import serialize_declarations, serialize_rules
 
 epub_folder = "./input_files"
 output_folder = "./processed_epubs"
+DRY_RUN = False
+DRY_RUN_REPORT = os.path.join(output_folder, "restore_dry_run.csv")
+MEMBER_WORKERS = os.cpu_count() or 1
+PARALLEL_SIZE_THRESHOLD = 2000000
+STYLE_CACHE_SIZE = 65536
+CSS_OUTPUT_STYLE = "pretty"
 TARGET_MARGIN_TOP = "1em"
 LARGE_FONT_THRESHOLD = 1.15
 
@@ -15,6 +30,16 @@ HEADER_INDICATORS = {
     '.chapter', '.section', '.heading', '.header'
 }
 
+CSS_EXTENSIONS = ('.css',)
+HTML_EXTENSIONS = ('.xhtml', '.html', '.htm', '.xht')
+MEDIA_TYPE_KINDS = {
+    'text/css': 'css',
+    'application/xhtml+xml': 'html',
+    'text/html': 'html',
+}
+CONTAINER_NAME = 'META-INF/container.xml'
+STYLE_PATTERN = re.compile(r'style', re.IGNORECASE)
+
 def is_likely_header_selector(selector):
     selector_lower = selector.lower().strip()
     for indicator in HEADER_INDICATORS:
@@ -180,6 +205,15 @@ def split_margin_shorthand(value):
         top = right = bottom = left = '0'
     return top, right, bottom, left, important
 
+def declaration_text(decl):
+    if ':' not in decl:
+        return decl
+    prop, value = decl.split(':', 1)
+    value = value.strip()
+    if value.endswith(';'):
+        value = value[:-1].strip()
+    return f"{prop.strip()}: {value}"
+
 def process_header_declaration(decl):
     if ':' not in decl:
         return decl, None
@@ -197,12 +231,14 @@ def process_header_declaration(decl):
         return f"margin: {TARGET_MARGIN_TOP} {right} {bottom} {left}{important_suffix}", 'margin'
     return f"{prop}: {value}", None
 
-def process_header_declarations(declarations):
+def process_header_declarations(declarations, stats=None):
     processed = []
     has_margin_top = False
     has_margin = False
     for decl in declarations:
         new_decl, modified_type = process_header_declaration(decl)
+        if stats is not None and new_decl != declaration_text(decl):
+            stats['declarations_rewritten'] += 1
         if modified_type == 'margin-top':
             has_margin_top = True
         elif modified_type == 'margin':
@@ -210,40 +246,38 @@ def process_header_declarations(declarations):
         processed.append(new_decl)
     if not has_margin_top and not has_margin:
         processed.append(f"margin-top: {TARGET_MARGIN_TOP}")
+        if stats is not None:
+            stats['declarations_rewritten'] += 1
     return processed
 
-def process_css_rules_for_headers(rules):
+def process_css_rules_for_headers(rules, stats=None):
     output = []
     for rule in rules:
         if rule['type'] == 'rule':
             selector = rule['selector']
             declarations = rule['declarations']
             if is_header_rule(selector, declarations):
-                processed_decls = process_header_declarations(declarations)
-                output.append(f"{selector} {{")
-                for decl in processed_decls:
-                    output.append(f"    {decl};")
-                output.append("}")
+                processed_decls = process_header_declarations(declarations, stats)
             else:
-                output.append(f"{selector} {{")
+                processed_decls = []
                 for decl in declarations:
                     if ':' in decl:
                         prop, value = decl.split(':', 1)
-                        output.append(f"    {prop.strip()}: {value.strip()};")
+                        processed_decls.append(f"{prop.strip()}: {value.strip()}")
                     else:
-                        output.append(f"    {decl};")
-                output.append("}")
-    return '\n'.join(output)
+                        processed_decls.append(decl)
+            output.append((selector, processed_decls))
+    return serialize_rules(output, CSS_OUTPUT_STYLE)
 
-def restore_header_margins_in_css(css_content):
+def restore_header_margins_in_css(css_content, stats=None):
     tokens = tokenize_css(css_content)
     rules = parse_css_rules(tokens)
-    return process_css_rules_for_headers(rules)
+    return process_css_rules_for_headers(rules, stats)
 
-def process_style_element(style_elem):
+def process_style_element(style_elem, stats=None):
     if style_elem.text:
         original = style_elem.text
-        processed = restore_header_margins_in_css(original)
+        processed = restore_header_margins_in_css(original, stats)
         style_elem.text = processed
         return original != processed
     return False
@@ -264,34 +298,45 @@ def is_header_element(elem):
             return True
     return False
 
-def process_style_attribute(elem):
+@lru_cache(maxsize=STYLE_CACHE_SIZE)
+def rewrite_header_style_attribute(style_attr):
+    declarations = [d.strip() for d in style_attr.split(';') if d.strip()]
+    style_stats = {'declarations_rewritten': 0}
+    processed_decls = process_header_declarations(declarations, style_stats)
+    return serialize_declarations(processed_decls, CSS_OUTPUT_STYLE), style_stats['declarations_rewritten']
+
+def process_style_attribute(elem, stats=None):
     style_attr = elem.get('style')
     if not style_attr:
         return False
     if not is_header_element(elem):
         return False
     original = style_attr
-    declarations = [d.strip() for d in style_attr.split(';') if d.strip()]
-    processed_decls = process_header_declarations(declarations)
-    new_style = '; '.join(processed_decls)
+    new_style, rewritten = rewrite_header_style_attribute(style_attr)
+    if stats is not None:
+        stats['declarations_rewritten'] += rewritten
+    if original == new_style:
+        return False
     elem.set('style', new_style)
-    return original != new_style
+    return True
 
-def process_html_content(html_content):
+def process_html_content(html_content, stats=None):
     try:
         tree = html.fromstring(html_content)
     except:
         try:
-            parser = etree.XMLParser(recover=True)
+            parser = etree.XMLParser(recover=True, encoding='utf-8')
             tree = etree.fromstring(html_content.encode('utf-8'), parser)
         except:
             return html_content, False
+    if tree is None:
+        return html_content, False
     modified = False
     for style_elem in tree.xpath('//style'):
-        if process_style_element(style_elem):
+        if process_style_element(style_elem, stats):
             modified = True
     for elem in tree.xpath('//*[@style]'):
-        if process_style_attribute(elem):
+        if process_style_attribute(elem, stats):
             modified = True
     if modified:
         try:
@@ -305,34 +350,137 @@ def process_html_content(html_content):
                 return html_content, False
     return html_content, False
 
+def get_member_kind(filename):
+    lower_name = filename.lower()
+    if lower_name.endswith(CSS_EXTENSIONS):
+        return 'css'
+    if lower_name.endswith(HTML_EXTENSIONS):
+        return 'html'
+    return None
+
+def read_member_kinds(zf):
+    try:
+        container = etree.fromstring(zf.read(CONTAINER_NAME))
+        opf_name = container.xpath('//*[local-name()="rootfile"]/@full-path')[0]
+        opf = etree.fromstring(zf.read(opf_name), etree.XMLParser(recover=True))
+    except Exception:
+        return None
+    if opf is None:
+        return None
+    member_kinds = {name: get_member_kind(name) for name in zf.namelist()}
+    opf_dir = posixpath.dirname(opf_name)
+    for item in opf.xpath('//*[local-name()="manifest"]/*[local-name()="item"][@href]'):
+        name = posixpath.normpath(posixpath.join(opf_dir, unquote(item.get('href').split('#')[0])))
+        if name in member_kinds:
+            member_kinds[name] = MEDIA_TYPE_KINDS.get(item.get('media-type', '').strip().lower())
+    return member_kinds
+
+def decode_text(data):
+    encoding, bom = detect_encoding(data)
+    try:
+        return data[len(bom):].decode(encoding)
+    except (UnicodeDecodeError, LookupError):
+        return None
+
+def analyze_epub(input_path):
+    stats = {
+        'book': os.path.basename(input_path),
+        'would_change': False,
+        'members_scanned': 0,
+        'css_files_changed': 0,
+        'html_files_changed': 0,
+        'declarations_rewritten': 0,
+        'projected_bytes_saved': 0,
+    }
+    with zipfile.ZipFile(input_path, 'r') as zf:
+        for info in zf.infolist():
+            kind = get_member_kind(info.filename)
+            if kind is None:
+                continue
+            stats['members_scanned'] += 1
+            data = zf.read(info)
+            text = data.decode('utf-8', errors='replace')
+            if kind == 'css':
+                new_text = restore_header_margins_in_css(text, stats)
+                changed = new_text != text
+                if changed:
+                    stats['css_files_changed'] += 1
+            elif STYLE_PATTERN.search(text):
+                new_text, changed = process_html_content(text, stats)
+                if changed:
+                    stats['html_files_changed'] += 1
+            else:
+                changed = False
+            if changed:
+                stats['projected_bytes_saved'] += len(data) - len(new_text.encode('utf-8'))
+    stats['would_change'] = bool(stats['css_files_changed'] or stats['html_files_changed'])
+    return stats
+
+def needs_changes(input_path):
+    with zipfile.ZipFile(input_path, 'r') as zf:
+        member_kinds = read_member_kinds(zf)
+        if member_kinds is None:
+            return True
+        for info in zf.infolist():
+            kind = member_kinds.get(info.filename)
+            if kind is None:
+                continue
+            note_member(info.filename)
+            text = decode_text(zf.read(info))
+            if text is None:
+                return True
+            if kind == 'css':
+                if restore_header_margins_in_css(text) != text:
+                    return True
+            elif STYLE_PATTERN.search(text) and process_html_content(text)[1]:
+                return True
+    return False
+
+def transform_member(job):
+    name, kind, text = job
+    note_member(name)
+    if kind == 'css':
+        new_text = restore_header_margins_in_css(text)
+        return new_text, new_text != text
+    return process_html_content(text)
+
+def transform_members(jobs):
+    total_size = sum(len(text) for name, kind, text in jobs)
+    workers = pool_workers(MEMBER_WORKERS)
+    if workers < 2 or len(jobs) < 2 or total_size < PARALLEL_SIZE_THRESHOLD:
+        return [transform_member(job) for job in jobs]
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(transform_member, jobs, chunksize=chunksize))
+
 def process_epub(input_path, output_path):
-    shutil.copy(input_path, output_path)
     try:
+        if not needs_changes(input_path):
+            print(f"No header margins to restore in: {output_path}")
+            return
+        shutil.copy(input_path, output_path)
         container = get_container(output_path)
         modified = False
+        jobs = []
         for name, mt in list(container.mime_map.items()):
             if mt == "text/css":
-                css_text = container.raw_data(name, decode=True)
-                new_css_text = restore_header_margins_in_css(css_text)
-                if new_css_text != css_text:
-                    container.replace(name, new_css_text)
-                    modified = True
+                jobs.append((name, 'css', container.raw_data(name, decode=True)))
             elif mt in ("application/xhtml+xml", "text/html"):
-                html_content = container.raw_data(name, decode=True)
-                new_content, content_modified = process_html_content(html_content)
-                if content_modified:
-                    container.replace(name, new_content)
-                    modified = True
+                jobs.append((name, 'html', container.raw_data(name, decode=True)))
+        for (name, kind, text), (new_text, content_modified) in zip(jobs, transform_members(jobs)):
+            if content_modified:
+                container.replace(name, new_text)
+                modified = True
         if modified:
             container.commit()
             print(f"Processed and saved: {output_path}")
         else:
             print(f"No header margins to restore in: {output_path}")
             os.remove(output_path)
-    except Exception as e:
-        print(f"Failed to process {output_path}: {e}")
+    except Exception:
         if os.path.exists(output_path):
             os.remove(output_path)
+        raise
 
 def main():
     os.makedirs(output_folder, exist_ok=True)
@@ -344,10 +492,19 @@ def main():
     if not epub_files:
         print(f"No EPUB files found in '{epub_folder}'.")
         return
-    for epub_file in epub_files:
-        epub_filename = os.path.basename(epub_file)
-        output_path = os.path.join(output_folder, epub_filename)
-        process_epub(epub_file, output_path)
+    if DRY_RUN:
+        rows = []
+        for epub_file in epub_files:
+            try:
+                stats = analyze_epub(epub_file)
+            except Exception as e:
+                print(f"Failed to analyze {epub_file}: {e}")
+                continue
+            print(f"{stats['book']}: {stats['declarations_rewritten']} declarations, {stats['projected_bytes_saved']:,} bytes")
+            rows.append(stats)
+        write_report(rows, DRY_RUN_REPORT)
+        return
+    run_batch(epub_files, output_folder, process_epub, "restore_margin")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,193 @@
+import os
+import io
+import re
+import string
+import zipfile
+import posixpath
+from html import unescape
+from concurrent.futures import ProcessPoolExecutor
+from fontTools import subset
+from fontTools.ttLib import TTFont
+from batch_runner import note_member, pool_workers, run_batch
+from convert_png import MANIFEST_ITEM_PATTERN, choose_compression, detect_encoding, get_attribute
+
+epub_folder = "input_files"
+output_folder = "output_files"
+FONT_POLICY = "subset"
+FONT_WORKERS = os.cpu_count() or 1
+BASE_CHARACTERS = string.printable
+FONT_EXTENSIONS = ('.ttf', '.otf', '.woff', '.woff2')
+HTML_EXTENSIONS = ('.xhtml', '.html', '.htm', '.xht')
+TAG_PATTERN = re.compile(r'<[^>]*>')
+FONT_FACE_PATTERN = re.compile(r'@font-face\s*\{[^}]*\}\s*', re.IGNORECASE)
+ENCRYPTED_URI_PATTERN = re.compile(r'<(?:\w+:)?CipherReference\b[^>]*\bURI\s*=\s*(["\'])(.*?)\1', re.DOTALL)
+
+def is_font_file(filename):
+    return filename.lower().endswith(FONT_EXTENSIONS)
+
+def decode_member(data):
+    encoding, bom = detect_encoding(data)
+    return data[len(bom):].decode(encoding), encoding, bom
+
+def collect_used_characters(texts):
+    characters = set(BASE_CHARACTERS)
+    for filename, text in texts:
+        if filename.lower().endswith(HTML_EXTENSIONS):
+            characters.update(unescape(TAG_PATTERN.sub(' ', text)))
+        else:
+            characters.update(text)
+    for character in list(characters):
+        characters.update(character.upper())
+        characters.update(character.lower())
+    return ''.join(sorted(characters))
+
+def find_encrypted_files(inf):
+    try:
+        data = inf.read('META-INF/encryption.xml').decode('utf-8', errors='replace')
+    except KeyError:
+        return set()
+    return {unescape(match.group(2)) for match in ENCRYPTED_URI_PATTERN.finditer(data)}
+
+def subset_font(job):
+    filename, data, characters = job
+    note_member(filename)
+    try:
+        font = TTFont(io.BytesIO(data))
+        options = subset.Options()
+        options.flavor = font.flavor
+        options.layout_features = ['*']
+        options.name_IDs = ['*']
+        options.name_languages = ['*']
+        options.notdef_outline = True
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(text=characters)
+        subsetter.subset(font)
+        output = io.BytesIO()
+        subset.save_font(font, output, options)
+        return output.getvalue(), None
+    except Exception as e:
+        return None, str(e)
+
+def subset_fonts(jobs):
+    workers = pool_workers(FONT_WORKERS)
+    if workers < 2 or len(jobs) < 2:
+        return [subset_font(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        return list(executor.map(subset_font, jobs))
+
+def remove_font_faces(css_text, removed_fonts):
+    removed_names = {name.split('/')[-1] for name in removed_fonts}
+    count = 0
+    def drop_font_face(match):
+        nonlocal count
+        block = match.group(0)
+        if any(name in block for name in removed_names):
+            count += 1
+            return ''
+        return block
+    return FONT_FACE_PATTERN.sub(drop_font_face, css_text), count
+
+def remove_manifest_items(opf_name, opf_text, removed_fonts):
+    opf_dir = posixpath.dirname(opf_name)
+    count = 0
+    def drop_font_item(match):
+        nonlocal count
+        href = get_attribute(match.group(0), 'href')
+        if href and posixpath.normpath(posixpath.join(opf_dir, unescape(href))) in removed_fonts:
+            count += 1
+            return ''
+        return match.group(0)
+    return MANIFEST_ITEM_PATTERN.sub(drop_font_item, opf_text), count
+
+def process_epub(input_path, output_path):
+    temp_output = output_path + '.tmp'
+    print(f"\nProcessing: {input_path}")
+    with zipfile.ZipFile(input_path, 'r') as inf:
+        infos = inf.infolist()
+        encrypted = find_encrypted_files(inf)
+        font_files = [info.filename for info in infos if is_font_file(info.filename)]
+        skipped = [name for name in font_files if name in encrypted]
+        font_files = [name for name in font_files if name not in encrypted]
+        for name in skipped:
+            print(f"  Skipping obfuscated font: {name}")
+        if not font_files:
+            print("  No embedded fonts to process")
+            return
+        new_fonts = {}
+        removed_fonts = set()
+        modified_text_files = {}
+        text_members = {}
+        for info in infos:
+            lower_name = info.filename.lower()
+            if not lower_name.endswith(('.css', '.opf') + HTML_EXTENSIONS):
+                continue
+            try:
+                text_members[info.filename] = decode_member(inf.read(info))
+            except UnicodeDecodeError as e:
+                print(f"  Could not decode {info.filename} ({e}); fonts left untouched")
+                return
+        if FONT_POLICY == "remove":
+            removed_fonts = set(font_files)
+            for filename, (text, encoding, bom) in text_members.items():
+                lower_name = filename.lower()
+                if lower_name.endswith('.opf'):
+                    new_text, count = remove_manifest_items(filename, text, removed_fonts)
+                elif '@font-face' in text.lower():
+                    new_text, count = remove_font_faces(text, removed_fonts)
+                else:
+                    continue
+                if count:
+                    modified_text_files[filename] = bom + new_text.encode(encoding)
+                    print(f"  {filename}: removed {count} font reference(s)")
+        else:
+            texts = [(filename, text) for filename, (text, encoding, bom) in text_members.items()
+                     if not filename.lower().endswith('.opf')]
+            characters = collect_used_characters(texts)
+            print(f"  {len(characters)} distinct characters used")
+            jobs = [(name, inf.read(name), characters) for name in font_files]
+            for (name, data, _), (new_data, error) in zip(jobs, subset_fonts(jobs)):
+                if error:
+                    print(f"  ERROR subsetting {name}: {error}")
+                elif len(new_data) < len(data):
+                    new_fonts[name] = new_data
+                    print(f"  {name}: {len(data):,} -> {len(new_data):,} bytes")
+        if not new_fonts and not removed_fonts:
+            print("  No font changes made")
+            return
+        with zipfile.ZipFile(temp_output, 'w') as outf:
+            for info in infos:
+                filename = info.filename
+                if filename in removed_fonts:
+                    continue
+                if filename in new_fonts:
+                    data = new_fonts[filename]
+                elif filename in modified_text_files:
+                    data = modified_text_files[filename]
+                else:
+                    data = inf.read(filename)
+                compress_type, level = choose_compression(filename, data)
+                outf.writestr(filename, data, compress_type=compress_type, compresslevel=level)
+    os.replace(temp_output, output_path)
+    font_bytes = sum(info.file_size for info in infos if info.filename in font_files)
+    new_font_bytes = sum(len(data) for data in new_fonts.values())
+    new_font_bytes += sum(info.file_size for info in infos if info.filename in font_files and info.filename not in new_fonts and info.filename not in removed_fonts)
+    input_size = os.path.getsize(input_path)
+    output_size = os.path.getsize(output_path)
+    print(f"  Fonts: {font_bytes:,} -> {new_font_bytes:,} bytes ({len(removed_fonts)} removed, {len(new_fonts)} subset)")
+    print(f"  EPUB: {input_size:,} -> {output_size:,} bytes ({input_size - output_size:,} saved)")
+
+def main():
+    os.makedirs(output_folder, exist_ok=True)
+    try:
+        epub_files = [os.path.join(epub_folder, f) for f in os.listdir(epub_folder) if f.lower().endswith(".epub")]
+    except FileNotFoundError:
+        print(f"The folder '{epub_folder}' does not exist.")
+        return
+    if not epub_files:
+        print(f"No EPUB files found in '{epub_folder}'.")
+        return
+    print(f"Found {len(epub_files)} EPUB file(s) to process")
+    run_batch(epub_files, output_folder, process_epub, "subset_fonts")
+
+if __name__ == "__main__":
+    main()